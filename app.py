@@ -4,18 +4,22 @@
 Program with web and physical interfaces to allow the control of a DAC that controls the power to the J2010 filament. Smoothly ramps up and ramps down the power to prevent damage to the crystal. Writes out a CSV file to ~/filament_controller_log.csv with the following columns:
 Raw Timestamp - Floating-point number of seconds since the Unix epoch.
 Formatted Timestamp - Timestamp of the format "%m/%d/%Y %I:%M:%S %p" (see the strftime (3) manpage for details).
-Control Type - PANEL, WEB, SHUTOFF, or AUTO, depending on whether the control action was initiated from the panel switches and buttons, the web interface, done automatically by the shutoff timer, or done automatically when the program started.
+Control Type - PANEL, WEB, SHUTOFF, or AUTO, depending on whether the control action was initiated from the panel switches and buttons, the web interface, done automatically by the shutoff timer, or done automatically when the program started or stopped.
 Control Action - SWITCH_TO_MANUAL_CONTROL, SWITCH_TO_COMPUTER_CONTROL, FILAMENT_ON, or FILAMENT_OFF, depending on what action was taken. The first two actions can only be initiated by PANEL control (by the user moving the physical switch), but the last two can be PANEL, WEB, SHUTOFF, or AUTO control.
 IP Address - A string like "192.168.1.168" with the IP address of the web request that initiated the action. Empty for PANEL actions.
 MAC Address - A string like "00:1B:44:11:3A:B7" with the MAC address of the computer that originated the action (may not be accurate if the computer is not on the same LAN as the Raspberry Pi). Empty for PANEL actions.
 """
 
 import RPi.GPIO as GPIO
+import pigpio
 
 RAMP_TIME_SECONDS = 30                        # Time over which the filament is to be ramped up or down, in seconds.
 SHUTOFF_TIMER_DURATION_SECONDS = 8 * 60 * 60  # Time, in seconds, after which the filament will be automatically shut off.
 ACTIVE_USER_MAX_IDLE_TIME_SECONDS = 5         # Time, in seconds, after which an active user who is not sending /status requests will be marked as inactive, in seconds.
 DAC_BITS = 12                                 # Number of bits offered by the DAC. Raw values sent to the dac will be in the range [0, 2^DAC_BITS).
+MAX_RAW_DAC = (1 << DAC_BITS) - 1             # Largest raw value that can be sent to the DAC.
+DAC_I2C_BUS = 1                               # Number of the I2C bus (/dev/i2c-N) that the DAC is connected to.
+DAC_I2C_ADDRESS = 0x62                        # I2C address of the MCP4725 DAC.
 RED_LED_PIN = 19                              # Pin number (BCM numbering scheme) used to control the red status LED.
 GREEN_LED_PIN = 26                            # Pin number (BCM numbering scheme) used to control the green status LED.
 CONTROL_MODE_SWITCH_PIN = 13                  # Pin number (BCM numbering scheme) used to read the switch that sets whether the filament is under manual or computer control.
@@ -23,50 +27,81 @@ CONTROL_MODE_PIN_STATE_MANUAL = GPIO.HIGH     # GPIO state of the CONTROL_MODE_S
 CONTROL_MODE_PIN_STATE_COMPUTER = GPIO.LOW    # GPIO state of the CONTROL_MODE_SWITCH_PIN that corresponds to computer control.
 ON_BUTTON_PIN = 6                             # GPIO state of the pin that corresponds to the on button. This pin should go LOW when pressed.
 OFF_BUTTON_PIN = 5                            # GPIO state of the pin that corresponds to the off button. This pin should go LOW when pressed.
+CONTROL_MODE_SWITCH_GLITCH_FILTER_US = 10000  # Time, in microseconds, that the CONTROL_MODE_SWITCH_PIN must hold a new level before the change is reported (filters out switch bounce).
+BUTTON_GLITCH_FILTER_US = 5000                # Time, in microseconds, that the ON_BUTTON_PIN or OFF_BUTTON_PIN must hold a new level before the change is reported (filters out button bounce).
 LED_FLASH_FREQUENCY_HZ = 1                    # Frequency (in Hertz) at which the status LED flashes.
+RAMP_TICK_SECONDS = 0.05                      # Time, in seconds, between DAC writes while ramping. Each write jumps the DAC to wherever the ramp should be by then.
+LOG_FLUSH_INTERVAL_SECONDS = 1.0              # Maximum time, in seconds, that a logged row may wait in memory before being flushed to the CSV logfile.
+LOG_FLUSH_THRESHOLD_ROWS = 64                 # Number of unflushed log rows that will cause the log worker to flush them before LOG_FLUSH_INTERVAL_SECONDS has passed.
+MAC_CACHE_TTL_SECONDS = 60                    # Time, in seconds, for which a looked-up MAC address is reused for the same IP address before ARP is consulted again.
+WEB_SERVER_THREADS = 8                        # Number of threads the web server uses to handle requests concurrently. More than the Pi's 4 cores, since threads spend most of their time waiting on clients' sockets.
 
+import sys
 import json
 import time
+import queue
+import atexit
+import signal
 import os.path
+import pathlib
+import statistics
+import itertools
 import threading
-from datetime import datetime
+import traceback
+import collections
 from getmac import get_mac_address
-from flask import Flask, render_template, jsonify, make_response, request
+from flask import Flask, Response, make_response, request
+from waitress import serve
 
 import board
 import busio
+import smbus2
 import adafruit_mcp4725
 
+# Modes for the status LED.
+LED_OFF = 0
+LED_SOLID_RED = 1
+LED_SOLID_GREEN = 2
+LED_FLASH_RED = 3
+LED_FLASH_GREEN = 4
+led_mode = LED_OFF # Current mode of the status LED.
+led_lock = threading.Lock() # Lock held while changing led_mode or driving the LED pins, so the flasher thread never turns a pin back on just after the mode has changed.
+
+# Function to change the status LED's mode. Solid and off modes are written to the pins right away; flashing modes are toggled by led_flasher_thread.
+def set_led_mode(mode):
+    global led_mode
+    with led_lock:
+        led_mode = mode
+        GPIO.output(RED_LED_PIN, GPIO.HIGH if mode == LED_SOLID_RED else GPIO.LOW)
+        GPIO.output(GREEN_LED_PIN, GPIO.HIGH if mode == LED_SOLID_GREEN else GPIO.LOW)
+
 # Functions to control the status LED.
 def status_led_off():
-    global red_led_pwm
-    global green_led_pwm
-    red_led_pwm.ChangeDutyCycle(0)
-    green_led_pwm.ChangeDutyCycle(0)
+    set_led_mode(LED_OFF)
 
 def status_led_solid_red():
-    global red_led_pwm
-    global green_led_pwm
-    red_led_pwm.ChangeDutyCycle(100)
-    green_led_pwm.ChangeDutyCycle(0)
+    set_led_mode(LED_SOLID_RED)
 
 def status_led_solid_green():
-    global red_led_pwm
-    global green_led_pwm
-    red_led_pwm.ChangeDutyCycle(0)
-    green_led_pwm.ChangeDutyCycle(100)
+    set_led_mode(LED_SOLID_GREEN)
 
 def status_led_flash_red():
-    global red_led_pwm
-    global green_led_pwm
-    red_led_pwm.ChangeDutyCycle(50)
-    green_led_pwm.ChangeDutyCycle(0)
+    set_led_mode(LED_FLASH_RED)
 
 def status_led_flash_green():
-    global red_led_pwm
-    global green_led_pwm
-    red_led_pwm.ChangeDutyCycle(0)
-    green_led_pwm.ChangeDutyCycle(50)
+    set_led_mode(LED_FLASH_GREEN)
+
+# Thread that flashes the status LED while it is in one of the flashing modes. A single thread toggling the pins replaces RPi.GPIO's software PWM, which ran a busy thread per LED even when the LED was solid.
+def led_flasher_thread():
+    lit = False
+    while True:
+        time.sleep(0.5 / LED_FLASH_FREQUENCY_HZ)
+        with led_lock:
+            lit = not lit
+            if led_mode == LED_FLASH_RED:
+                GPIO.output(RED_LED_PIN, GPIO.HIGH if lit else GPIO.LOW)
+            elif led_mode == LED_FLASH_GREEN:
+                GPIO.output(GREEN_LED_PIN, GPIO.HIGH if lit else GPIO.LOW)
 
 # States for the controller state machine.
 STARTING = 0
@@ -75,97 +110,198 @@ ON = 2
 RAMP_UP = 3
 RAMP_DOWN = 4
 state = STARTING # Current state of the controller state machine.
+state_lock = threading.RLock() # Lock held while reading or changing state, dac_value, shutoff_timer_start, computer_control, or max_dac_value, so that other threads (web requests, GPIO callbacks) never see a half-finished transition or set the status LED from a stale state.
+_status_version = 0 # Incremented whenever something reported by /status changes other than the once-per-second countdown; used to build the /status ETag.
+_status_version_counter = itertools.count(1) # Source of new _status_version values (next() on it is atomic, unlike += on a global).
+
+# Function to mark the /status response as changed, so clients holding an old ETag get a fresh response.
+def bump_status_version():
+    global _status_version
+    _status_version = next(_status_version_counter)
 
 dac_value = 0 # Current value of the DAC (will be initialized by the controller thread).
-max_dac_value = int(open("/home/pi/FilamentController/max_dac_value.txt").read().replace('\n', ''))  # Maximum allowed value of the DAC.
-on_button_pressed = False # Whether the ON button was just pressed, either on the webpage or the physical buttons.
-off_button_pressed = False # Whether the OFF button was just pressed, either on the webpage or the physical buttons.
+max_dac_value = int(pathlib.Path("/home/pi/FilamentController/max_dac_value.txt").read_text().strip(), 10)  # Maximum allowed value of the DAC.
+_ramp_interval = RAMP_TIME_SECONDS / (max_dac_value + 1) # Time, in seconds, between DAC steps while ramping. Recomputed whenever max_dac_value changes.
+_status_json_suffix = ',"max_dac_value":{},"dac_bits":{}}}'.format(max_dac_value, DAC_BITS) # End of the /status JSON body, holding the fields that only change when max_dac_value does. Rebuilt whenever max_dac_value changes.
+settings_lock = threading.Lock() # Lock held by /setup from changing max_dac_value until the new value is on the SD card, so concurrent requests can't interleave their writes to max_dac_value.txt.
+stop_event = threading.Event() # Set to tell the controller thread to ramp the filament down and exit.
+pending_events = queue.SimpleQueue() # Queue of "ON" and "OFF" button presses, from either the webpage or the physical buttons, waiting to be handled by the controller thread.
 computer_control = True # Whether the filament is currently being controlled by the Pi or by the manual knob.
-active_users = {} # Dictionary associating connected web clients' IP addresses and the time.time() timestamp at which they last called the /status endpoint.
-shutoff_timer_start = time.time() # When (in seconds since the Unix epoch) the shutoff timer was started.
+active_users = collections.OrderedDict() # Dictionary associating connected web clients' IP addresses and the time.monotonic() timestamp at which they last called the /status endpoint, ordered from least to most recently seen.
+active_users_lock = threading.Lock() # Lock protecting active_users, which is updated by concurrent /status requests.
+shutoff_timer_start = time.monotonic() # When (in time.monotonic() seconds) the shutoff timer was started.
 
 # Set up GPIO.
 GPIO.setmode(GPIO.BCM)
-GPIO.setup(RED_LED_PIN, GPIO.OUT)
-red_led_pwm = GPIO.PWM(RED_LED_PIN, LED_FLASH_FREQUENCY_HZ)
-red_led_pwm.start(0.0)
-GPIO.setup(GREEN_LED_PIN, GPIO.OUT)
-green_led_pwm = GPIO.PWM(GREEN_LED_PIN, LED_FLASH_FREQUENCY_HZ)
-green_led_pwm.start(0.0)
-GPIO.setup(CONTROL_MODE_SWITCH_PIN, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-if GPIO.input(CONTROL_MODE_SWITCH_PIN) == CONTROL_MODE_PIN_STATE_MANUAL:
+GPIO.setup(RED_LED_PIN, GPIO.OUT, initial = GPIO.LOW)
+GPIO.setup(GREEN_LED_PIN, GPIO.OUT, initial = GPIO.LOW)
+threading.Thread(target = led_flasher_thread, daemon = True).start()
+# The switch and buttons are read through the pigpio daemon, whose glitch filters debounce them before any callback runs. RPi.GPIO's software debouncing could dispatch a callback twice for one transition (see test.py).
+pi = pigpio.pi()
+if not pi.connected:
+    raise SystemExit("Could not connect to the pigpio daemon. Start it with \"sudo pigpiod\".")
+pi.set_mode(CONTROL_MODE_SWITCH_PIN, pigpio.INPUT)
+pi.set_pull_up_down(CONTROL_MODE_SWITCH_PIN, pigpio.PUD_UP)
+pi.set_glitch_filter(CONTROL_MODE_SWITCH_PIN, CONTROL_MODE_SWITCH_GLITCH_FILTER_US)
+if pi.read(CONTROL_MODE_SWITCH_PIN) == CONTROL_MODE_PIN_STATE_MANUAL:
     computer_control = False
     status_led_off()
-GPIO.setup(ON_BUTTON_PIN, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-GPIO.setup(OFF_BUTTON_PIN, GPIO.IN, pull_up_down = GPIO.PUD_UP)
+for button_pin in (ON_BUTTON_PIN, OFF_BUTTON_PIN):
+    pi.set_mode(button_pin, pigpio.INPUT)
+    pi.set_pull_up_down(button_pin, pigpio.PUD_UP)
+    pi.set_glitch_filter(button_pin, BUTTON_GLITCH_FILTER_US)
 
-# Interrupt request handler for the manual/computer control switch.
-def control_switch_interrupt(_):
+# Interrupt request handler for the manual/computer control switch. The glitch filter only reports a level once it has been steady, so the level passed in can be used directly.
+def control_switch_interrupt(gpio, level, tick):
     global computer_control
-    time.sleep(0.01) # If you sleep for too long, the RPi.GPIO library will dispatch two ISRs. If it's too short, then the GPIO.input() may read a bouncing switch value. This value seems to work well with the 50 ms debounce.
-    if GPIO.input(CONTROL_MODE_SWITCH_PIN) == CONTROL_MODE_PIN_STATE_MANUAL:
-        computer_control = False
-        status_led_off()
-    else:
-        computer_control = True
-        if state == OFF or state == STARTING:
-            status_led_solid_red()
-        elif state == ON:
-            status_led_solid_green()
-        elif state == RAMP_UP:
-            status_led_flash_green()
-        elif state == RAMP_DOWN:
-            status_led_flash_red()
-GPIO.add_event_detect(CONTROL_MODE_SWITCH_PIN, GPIO.BOTH, callback = control_switch_interrupt, bouncetime = 50)
+    with state_lock:
+        if level == CONTROL_MODE_PIN_STATE_MANUAL:
+            computer_control = False
+            bump_status_version()
+            status_led_off()
+        else:
+            computer_control = True
+            bump_status_version()
+            if state == OFF or state == STARTING:
+                status_led_solid_red()
+            elif state == ON:
+                status_led_solid_green()
+            elif state == RAMP_UP:
+                status_led_flash_green()
+            elif state == RAMP_DOWN:
+                status_led_flash_red()
+control_switch_callback = pi.callback(CONTROL_MODE_SWITCH_PIN, pigpio.EITHER_EDGE, control_switch_interrupt)
 
 # Interrupt request handler for the on button.
-def on_button_pressed_interrupt(_):
-    global on_button_pressed
+def on_button_pressed_interrupt(gpio, level, tick):
     if computer_control:
-        on_button_pressed = True
-GPIO.add_event_detect(ON_BUTTON_PIN, GPIO.FALLING, callback = on_button_pressed_interrupt, bouncetime = 50)
+        pending_events.put("ON")
+on_button_callback = pi.callback(ON_BUTTON_PIN, pigpio.FALLING_EDGE, on_button_pressed_interrupt)
 
 # Interrupt request handler for the off button.
-def off_button_pressed_interrupt(_):
-    global off_button_pressed
+def off_button_pressed_interrupt(gpio, level, tick):
     if computer_control:
-        off_button_pressed = True
-GPIO.add_event_detect(OFF_BUTTON_PIN, GPIO.FALLING, callback = off_button_pressed_interrupt, bouncetime = 50)
+        pending_events.put("OFF")
+off_button_callback = pi.callback(OFF_BUTTON_PIN, pigpio.FALLING_EDGE, off_button_pressed_interrupt)
 
 # Set up logging.
 logfile_name = "/home/pi/filament_controller_log.csv"
 if os.path.exists(logfile_name):
-    logfile = open(logfile_name, 'a')
+    logfile = open(logfile_name, 'a', buffering = 65536)
 else:
-    logfile = open(logfile_name, 'w')
+    logfile = open(logfile_name, 'w', buffering = 65536)
     logfile.write("Raw Timestamp,Formatted Timestamp,Control Type,Control Action,IP Address,MAC Address\n")
 
-# Function to write a row to the CSV logfile.
-def log_action(control_type, control_action, ip_address):
-    global logfile
-    if ip_address != "":
+log_queue = queue.SimpleQueue() # Tuples of (raw timestamp, control type, control action, IP address) waiting to be written to the CSV logfile by the log worker thread, or None to tell the log worker to close the logfile and exit.
+_mac_cache = {} # Dictionary associating IP addresses with a tuple of (time.monotonic() timestamp of the lookup, MAC address). Only used by the log worker thread.
+_formatted_timestamp_cache = (None, "") # Tuple of (whole Unix second, formatted timestamp) for the most recently logged row, so strftime only runs once per second.
+
+# Function to look up the MAC address for an IP address. Results are reused for MAC_CACHE_TTL_SECONDS, so repeated requests from the same client skip the ARP lookup.
+def cached_mac_address(ip_address):
+    now = time.monotonic()
+    lookup_time, mac_address = _mac_cache.get(ip_address, (None, None))
+    if lookup_time is None or now - lookup_time > MAC_CACHE_TTL_SECONDS:
         if ':' in ip_address:
             mac_address = get_mac_address(ip6 = ip_address)
         else:
             mac_address = get_mac_address(ip = ip_address)
+        _mac_cache[ip_address] = (now, mac_address)
+    return mac_address
+
+# Function to queue a row for the CSV logfile. The MAC address lookup, formatting, and writing all happen in the log worker thread, so web requests never wait on ARP or the SD card.
+def log_action(control_type, control_action, ip_address):
+    log_queue.put((time.time(), control_type, control_action, ip_address))
+
+# Function to turn a queued log entry into a CSV row.
+def format_log_row(raw_timestamp, control_type, control_action, ip_address):
+    global _formatted_timestamp_cache
+    if ip_address != "":
+        mac_address = cached_mac_address(ip_address)
     else:
             mac_address = ""
-    raw_timestamp = time.time()
-    formatted_timestamp = datetime.fromtimestamp(raw_timestamp).strftime("%m/%d/%Y %I:%M:%S %p")
-    logfile.write("{},{},{},{},{},{}\n".format(raw_timestamp, formatted_timestamp, control_type, control_action, ip_address, mac_address))
-    logfile.flush()
+    second = int(raw_timestamp)
+    cached_second, formatted_timestamp = _formatted_timestamp_cache
+    if second != cached_second:
+        formatted_timestamp = time.strftime("%m/%d/%Y %I:%M:%S %p", time.localtime(raw_timestamp))
+        _formatted_timestamp_cache = (second, formatted_timestamp)
+    return ','.join((repr(raw_timestamp), formatted_timestamp, control_type, control_action, ip_address, str(mac_address))) + '\n'
+
+# Function to write out any queued rows and close the CSV logfile. The log worker does the writing and closing itself, so no row it has already taken off the queue can be lost. Safe to call more than once.
+def close_logfile():
+    if log_worker_thread.is_alive():
+        log_queue.put(None)
+        log_worker_thread.join()
+    if logfile.closed:
+        return
+    # The log worker never ran, so nothing else is touching the logfile or the caches.
+    try:
+        while True:
+            entry = log_queue.get_nowait()
+            if entry is not None:
+                logfile.write(format_log_row(*entry))
+    except queue.Empty:
+        pass
+    logfile.close()
+atexit.register(close_logfile)
+
+# Signal handler for Ctrl+C (SIGINT) and SIGTERM (e.g. from systemd). The first signal tells the controller thread to stop and raises KeyboardInterrupt, which makes the web server return so the filament is ramped down and buffered log rows reach the SD card. Any further signals are ignored rather than allowed to interrupt the main thread while it waits for the ramp-down, since exiting then would leave the DAC (which holds its output without the Pi) part way up.
+def shutdown_signal_handler(signum, frame):
+    if not stop_event.is_set():
+        stop_event.set()
+        raise KeyboardInterrupt
+signal.signal(signal.SIGINT, shutdown_signal_handler)
+signal.signal(signal.SIGTERM, shutdown_signal_handler)
+
+# This function runs in a separate thread and writes queued log entries to the CSV logfile. Rows go into the logfile's buffer as they arrive, and the buffer is flushed once LOG_FLUSH_INTERVAL_SECONDS have passed since the first unflushed row or LOG_FLUSH_THRESHOLD_ROWS rows have built up.
+def log_worker():
+    while True:
+        entry = log_queue.get()
+        flush_deadline = time.monotonic() + LOG_FLUSH_INTERVAL_SECONDS
+        unflushed_rows = 0
+        while True:
+            if entry is None:
+                try:
+                    logfile.close()
+                except Exception:
+                    traceback.print_exc()
+                return
+            # A failure on one row (e.g. an SD card write error) is reported and skipped, so it can't stop logging for the rest of the run.
+            try:
+                logfile.write(format_log_row(*entry))
+            except Exception:
+                print("Failed to write row to the CSV logfile: {}".format(entry), file = sys.stderr)
+                traceback.print_exc()
+            unflushed_rows += 1
+            if unflushed_rows >= LOG_FLUSH_THRESHOLD_ROWS:
+                break
+            try:
+                entry = log_queue.get(timeout = max(0, flush_deadline - time.monotonic()))
+            except queue.Empty:
+                break
+        try:
+            logfile.flush()
+        except Exception:
+            traceback.print_exc()
+log_worker_thread = threading.Thread(target = log_worker, daemon = True)
+
+# Function to throw away any button presses that are waiting to be handled. Used while ramping, when neither button does anything.
+def discard_pending_events():
+    try:
+        while True:
+            pending_events.get_nowait()
+    except queue.Empty:
+        pass
 
 # This function runs in a separate thread and handles actually controlling the filament.
 def controller_thread():
     global state
     global dac_value
-    global on_button_pressed
-    global off_button_pressed
-    global shutoff_timer_start
     # Open the DAC device.
     i2c = busio.I2C(board.SCL, board.SDA)
-    dac = adafruit_mcp4725.MCP4725(i2c)
-    # Get the current value of the DAC. We read the value 10 times from I2C to avoid reading an erroneously high value that would cause the RAMP_DOWN state to write that erroneously high value back to the DAC and break the crystal.
+    dac = adafruit_mcp4725.MCP4725(i2c, address = DAC_I2C_ADDRESS)
+    # The Adafruit driver is only used for reading the DAC. Ramp writes go straight to SMBus as MCP4725 fast-mode writes (command byte holds the upper 4 bits, data byte the lower 8), which skips the driver's per-write overhead.
+    write_dac_block = smbus2.SMBus(DAC_I2C_BUS).write_i2c_block_data
+    # Get the current value of the DAC. We read the value 10 times from I2C and take the median to avoid reading an erroneously high value that would cause the RAMP_DOWN state to write that erroneously high value back to the DAC and break the crystal. Unlike the mean, the median ignores a single bad reading entirely.
     dac_readings = []
     print("Starting controller...", end = '', flush = True)
     for _ in range(10):
@@ -173,160 +309,283 @@ def controller_thread():
         print('.', end = '', flush = True)
         time.sleep(0.05)
     print("\nController started.")
-    dac_value = int(sum(dac_readings) / float(len(dac_readings)))
+    dac_value = statistics.median_low(dac_readings)
     # If the DAC isn't off right now, ramp down.
-    if dac_value > 0:
-        log_action("AUTO", "FILAMENT_OFF", "")
-        state = RAMP_DOWN
-        if computer_control:
-            status_led_flash_red()
-    else:
-        state = OFF
-        if computer_control:
-            status_led_solid_red()
-    # Main state machine loop.
-    while True:
-        if state == OFF:
-            if on_button_pressed:
-                shutoff_timer_start = time.time()
+    with state_lock:
+        if dac_value > 0:
+            log_action("AUTO", "FILAMENT_OFF", "")
+            state = RAMP_DOWN
+            bump_status_version()
+            if computer_control:
+                status_led_flash_red()
+        else:
+            state = OFF
+            bump_status_version()
+            if computer_control:
+                status_led_solid_red()
+    # State machine. Each state has a handler that runs one step of that state; the main loop looks up and calls the handler for the current state. The OFF and ON handlers block on pending_events instead of polling. The RAMP handlers wake up every RAMP_TICK_SECONDS and set the DAC to the value the ramp should have reached by then, so a ramp takes RAMP_TIME_SECONDS with far fewer I2C writes than one per DAC step.
+    ramp_start = None # time.monotonic() timestamp at which the current ramp started, or None when not ramping.
+    ramp_start_dac_value = 0 # Value of the DAC when the current ramp started.
+    ramp_next_tick = 0.0 # time.monotonic() timestamp at which the next ramp tick is due. Ticks are scheduled on absolute deadlines so time spent writing the DAC doesn't stretch the tick spacing.
+
+    # Function to wait for the next ramp tick and return how many DAC steps the current ramp should have made by then.
+    def wait_for_ramp_tick():
+        nonlocal ramp_start
+        nonlocal ramp_start_dac_value
+        nonlocal ramp_next_tick
+        discard_pending_events()
+        if ramp_start is None:
+            ramp_start = time.monotonic()
+            ramp_start_dac_value = dac_value
+            ramp_next_tick = ramp_start
+        ramp_next_tick += RAMP_TICK_SECONDS
+        sleep_time = ramp_next_tick - time.monotonic()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+        elif sleep_time < -RAMP_TICK_SECONDS:
+            ramp_next_tick = time.monotonic() # Fell more than a tick behind; don't try to make up the missed ticks with a burst of writes.
+        return int((time.monotonic() - ramp_start) / _ramp_interval)
+
+    # Function to send a new value to the DAC.
+    def set_dac_value(new_dac_value):
+        global dac_value
+        write_dac_block(DAC_I2C_ADDRESS, (new_dac_value >> 8) & 0x0F, [new_dac_value & 0xFF])
+        with state_lock:
+            dac_value = new_dac_value
+
+    # Handler for the OFF state: wait for the ON button.
+    def handle_off():
+        global state
+        global shutoff_timer_start
+        if pending_events.get() == "ON":
+            with state_lock:
+                shutoff_timer_start = time.monotonic()
                 status_led_flash_green()
                 state = RAMP_UP
-            off_button_pressed = False
-            on_button_pressed = False
-            time.sleep(0.1)
-        elif state == RAMP_UP:
-            off_button_pressed = False
-            on_button_pressed = False
-            time.sleep(float(RAMP_TIME_SECONDS) / (max_dac_value + 1))
-            dac_value += 1
-            dac.raw_value = dac_value
-            if dac_value >= max_dac_value:
+                bump_status_version()
+
+    # Handler for the RAMP_UP state: move the DAC one tick further up the ramp.
+    def handle_ramp_up():
+        global state
+        nonlocal ramp_start
+        ramp_steps = wait_for_ramp_tick()
+        target_dac_value = min(max_dac_value, ramp_start_dac_value + ramp_steps)
+        if target_dac_value != dac_value:
+            set_dac_value(target_dac_value)
+        if dac_value >= max_dac_value:
+            ramp_start = None
+            with state_lock:
                 state = ON
+                bump_status_version()
                 status_led_solid_green()
-        elif state == ON:
-            if off_button_pressed:
+
+    # Handler for the ON state: wait for the OFF button or the shutoff timer, whichever comes first.
+    def handle_on():
+        global state
+        try:
+            event = pending_events.get(timeout = max(0, shutoff_timer_start + SHUTOFF_TIMER_DURATION_SECONDS - time.monotonic()))
+        except queue.Empty:
+            event = None
+        with state_lock:
+            if event == "OFF":
                 state = RAMP_DOWN
+                bump_status_version()
                 status_led_flash_red()
-            if time.time() - shutoff_timer_start >= SHUTOFF_TIMER_DURATION_SECONDS:
+            if time.monotonic() - shutoff_timer_start >= SHUTOFF_TIMER_DURATION_SECONDS:
                 state = RAMP_DOWN
+                bump_status_version()
                 status_led_flash_red()
                 log_action("SHUTOFF", "FILAMENT_OFF", "")
-            off_button_pressed = False
-            on_button_pressed = False
-            time.sleep(0.1)
-        elif state == RAMP_DOWN:
-            off_button_pressed = False
-            on_button_pressed = False
-            time.sleep(float(RAMP_TIME_SECONDS) / (max_dac_value + 1))
-            dac_value -= 1
-            dac.raw_value = dac_value
-            if dac_value <= 0:
+
+    # Handler for the RAMP_DOWN state: move the DAC one tick further down the ramp.
+    def handle_ramp_down():
+        global state
+        nonlocal ramp_start
+        ramp_steps = wait_for_ramp_tick()
+        target_dac_value = max(0, ramp_start_dac_value - ramp_steps)
+        if target_dac_value != dac_value:
+            set_dac_value(target_dac_value)
+        if dac_value <= 0:
+            ramp_start = None
+            with state_lock:
                 state = OFF
+                bump_status_version()
                 status_led_solid_red()
 
+    state_handlers = {OFF: handle_off, ON: handle_on, RAMP_UP: handle_ramp_up, RAMP_DOWN: handle_ramp_down}
+    while not stop_event.is_set():
+        state_handlers[state]()
+    # The program is stopping. Never leave the filament powered without the program running to shut it off: ramp it down (starting from wherever it is now) before returning.
+    with state_lock:
+        if state != OFF and state != RAMP_DOWN:
+            log_action("AUTO", "FILAMENT_OFF", "")
+            ramp_start = None
+            state = RAMP_DOWN
+            bump_status_version()
+            status_led_flash_red()
+    while state == RAMP_DOWN:
+        handle_ramp_down()
+
 # Function to update the active users' dictionary by adding the specified IP and dropping any IPs that have not made a /status request in ACTIVE_USER_MAX_IDLE_TIME_SECONDS seconds.
 def update_active_users(ip_address):
-    global active_users
-    now = time.time()
+    now = time.monotonic()
+    if ip_address in active_users:
+        active_users.move_to_end(ip_address)
+    else:
+        bump_status_version()
     active_users[ip_address] = now
-    new_active_users = {}
-    for ip, timestamp in active_users.items():
+    # Entries are ordered by last-seen time, so only the stale ones at the front need to be looked at.
+    while active_users:
+        _, timestamp = next(iter(active_users.items()))
         if now - timestamp <= ACTIVE_USER_MAX_IDLE_TIME_SECONDS:
-            new_active_users[ip] = timestamp
-    active_users = new_active_users
+            break
+        active_users.popitem(last = False)
+        bump_status_version()
 
 # Set up web server.
 app = Flask(__name__)
-app.config["SECRET_KEY"] = open("/home/pi/secret_key.txt").read().replace('\n', '')
+app.config["SECRET_KEY"] = pathlib.Path("/home/pi/secret_key.txt").read_text().strip()
+app.config["TEMPLATES_AUTO_RELOAD"] = False
+app.debug = False
+# The templates never change while the server is running, so load and compile them once here instead of looking them up (and stat-ing the files on the SD card) on every request.
+app.jinja_env.auto_reload = False
+index_template = app.jinja_env.get_template("index.html")
+setup_template = app.jinja_env.get_template("setup.html")
 
 # Homepage.
 @app.route('/')
 @app.route("/index")
 def index():
-    return render_template("index.html")
+    return index_template.render()
 
 # Setup page.
 @app.route("/setup", methods = ["GET", "POST"])
 def setup():
     global max_dac_value
+    global _ramp_interval
+    global _status_json_suffix
     if request.method == "GET":
-        return render_template("setup.html")
+        return setup_template.render()
     elif request.method == "POST":
-        if state != OFF:
-            return make_response("Error: You cannot change the settings while the filament is on, ramping up, or ramping down. Switch the filament off before attempting to modify settings.", 400)
         try:
             max_virtual_knob_value = float(request.form["max_virtual_knob_value"])
         except:
             return make_response("Error: Invalid or empty value for maximum virtual knob value.", 400)
         if max_virtual_knob_value <= 0.0 or max_virtual_knob_value > 10.0:
             return make_response("Error: Maximum virtual knob value must be in the range (0.0, 10.0].", 400)
-        max_dac_value = int((max_virtual_knob_value / 10.0) * (2 ** DAC_BITS - 1))
-        try:
-            open("./max_dac_value.txt", 'w').write("{}".format(max_dac_value))
-        except:
-            return make_response("Error: Failed to save new maximum virtual knob setting to disk. The Raspberry Pi's SD card may be failing.", 400)
+        with settings_lock:
+            with state_lock:
+                if state != OFF:
+                    return make_response("Error: You cannot change the settings while the filament is on, ramping up, or ramping down. Switch the filament off before attempting to modify settings.", 400)
+                max_dac_value = int((max_virtual_knob_value / 10.0) * MAX_RAW_DAC)
+                new_max_dac_value = max_dac_value
+                _ramp_interval = RAMP_TIME_SECONDS / (max_dac_value + 1)
+                _status_json_suffix = ',"max_dac_value":{},"dac_bits":{}}}'.format(max_dac_value, DAC_BITS)
+                bump_status_version()
+            try:
+                # Write to a temporary file, make sure it has reached the SD card, and then swap it into place, so neither a failed write nor a power cut can leave a truncated setting behind.
+                with open("./max_dac_value.txt.tmp", 'w') as max_dac_value_file:
+                    max_dac_value_file.write("{}".format(new_max_dac_value))
+                    max_dac_value_file.flush()
+                    os.fsync(max_dac_value_file.fileno())
+                os.replace("./max_dac_value.txt.tmp", "./max_dac_value.txt")
+            except:
+                return make_response("Error: Failed to save new maximum virtual knob setting to disk. The Raspberry Pi's SD card may be failing.", 400)
         return make_response("Successfully changed maximum virtual knob setting.", 200)
 
 # API endpoint to switch the filament on.
 @app.route("/filament-on")
 def filamentOn():
-    global on_button_pressed
-    if not computer_control:
-        return "Filament cannot be controlled from the API when in manual (knob) control mode."
-    on_button_pressed = True
+    with state_lock:
+        if not computer_control:
+            return "Filament cannot be controlled from the API when in manual (knob) control mode."
+        pending_events.put("ON")
+        current_state = state
     log_action("WEB", "FILAMENT_ON", str(request.remote_addr))
-    if state == ON:
+    if current_state == ON:
         return "Filament is already on; you cannot turn it on while it is already on."
-    elif state == OFF:
+    elif current_state == OFF:
         return "Turning filament on..."
-    elif state == RAMP_UP:
+    elif current_state == RAMP_UP:
         return "Filament is ramping up; you cannot turn it on while it is already turning on."
-    elif state == RAMP_DOWN:
+    elif current_state == RAMP_DOWN:
         return "Filament is ramping down; you cannot turn it on while it is already turning off."
 
 # API endpoint to switch the filament off.
 @app.route("/filament-off")
 def filamentOff():
-    global off_button_pressed
-    if not computer_control:
-        return "Filament cannot be controlled from the API when in manual (knob) control mode."
-    off_button_pressed = True
+    with state_lock:
+        if not computer_control:
+            return "Filament cannot be controlled from the API when in manual (knob) control mode."
+        pending_events.put("OFF")
+        current_state = state
     log_action("WEB", "FILAMENT_OFF", str(request.remote_addr))
-    if state == ON:
+    if current_state == ON:
         return "Turning filament off..."
-    elif state == OFF:
+    elif current_state == OFF:
         return "Filament is already off; you cannot turn it off while it is already off."
-    elif state == RAMP_UP:
+    elif current_state == RAMP_UP:
         return "Filament is ramping up; you cannot turn it off while it is already turning on."
-    elif state == RAMP_DOWN:
+    elif current_state == RAMP_DOWN:
         return "Filament is ramping down; you cannot turn it off while it is already turning off."
 
 # API endpoint to get the current filament control status.
+_status_message_cache = (None, "") # Tuple of (ETag, filament status message) for the most recently built /status response.
 @app.route("/status")
 def status():
-    global filament_status_message
-    update_active_users(request.remote_addr)
-    if state == ON:
-        remaining_time = SHUTOFF_TIMER_DURATION_SECONDS - (time.time() - shutoff_timer_start)
-        hours_left = int(remaining_time // 3600)
-        minutes_left = int((remaining_time - (3600 * hours_left)) // 60)
-        seconds_left = int(remaining_time - (3600 * hours_left) - (60 * minutes_left))
-        filament_status_message = "Filament is ON, {} H:{} M:{} S left until automatic shutoff.".format(hours_left, minutes_left, seconds_left)
-    elif state == OFF:
-        filament_status_message = "Filament is OFF."
-    elif state == RAMP_UP:
-        filament_status_message = "Filament is ramping up ({}% complete)...".format(int(float(dac_value) / max_dac_value * 100))
-    elif state == RAMP_DOWN:
-        filament_status_message = "Filament is ramping down ({}% complete)...".format(int(100 - float(dac_value) / max_dac_value * 100))
-    return make_response(jsonify({"computer_control": computer_control, "filament_status_message": filament_status_message, "active_users": len(active_users), "max_dac_value": max_dac_value, "dac_bits": DAC_BITS}), 200)
+    global _status_message_cache
+    with active_users_lock:
+        update_active_users(request.remote_addr)
+        num_active_users = len(active_users)
+    with state_lock:
+        # The ETag changes whenever the status does, and at least once per second so the shutoff countdown and ramp progress stay current.
+        etag = "{}-{}".format(_status_version, int(time.monotonic()))
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+            response.set_etag(etag)
+            return response
+        # The status message only needs to be rebuilt when the ETag changes; every other poll in the same second reuses it.
+        cached_etag, filament_status_message = _status_message_cache
+        if cached_etag != etag:
+            if state == ON:
+                remaining_time = int(SHUTOFF_TIMER_DURATION_SECONDS - (time.monotonic() - shutoff_timer_start))
+                hours_left, remaining_time = divmod(remaining_time, 3600)
+                minutes_left, seconds_left = divmod(remaining_time, 60)
+                filament_status_message = "Filament is ON, {} H:{} M:{} S left until automatic shutoff.".format(hours_left, minutes_left, seconds_left)
+            elif state == OFF:
+                filament_status_message = "Filament is OFF."
+            elif state == RAMP_UP:
+                filament_status_message = "Filament is ramping up ({}% complete)...".format(dac_value * 100 // max_dac_value)
+            elif state == RAMP_DOWN:
+                filament_status_message = "Filament is ramping down ({}% complete)...".format((max_dac_value - dac_value) * 100 // max_dac_value)
+            _status_message_cache = (etag, filament_status_message)
+        # The payload always has the same shape and only the status message can contain characters that need escaping, so the JSON is built by hand rather than through jsonify.
+        body = ('{{"computer_control":{},"filament_status_message":{},"active_users":{}'.format(str(computer_control).lower(), json.dumps(filament_status_message), num_active_users) + _status_json_suffix).encode()
+    response = Response(body, mimetype = "application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache" # Make browsers revalidate with If-None-Match on every poll instead of reusing a cached status.
+    return response
 
 if __name__ == "__main__":
+    t = threading.Thread(target = controller_thread)
+    t.start()
+    log_worker_thread.start()
     try:
-        t = threading.Thread(target = controller_thread)
-        t.start()
         while state == STARTING:
             time.sleep(0.1)
-        app.run(host = "0.0.0.0", port = 80)
+        # serve() catches a Ctrl+C or SIGTERM itself and returns normally instead of raising, so the shutdown sequence must run in the finally block rather than in an except clause.
+        serve(app, host = "0.0.0.0", port = 80, threads = WEB_SERVER_THREADS)
     except KeyboardInterrupt:
-        GPIO.cleanup()
-        logfile.close()
+        pass # Interrupted before the web server started; shut down below all the same.
+    finally:
+        print("Stopping controller (ramping the filament down first)...")
+        stop_event.set()
+        pending_events.put("STOP") # Wake the controller thread if it is waiting for a button press.
+        t.join(timeout = RAMP_TIME_SECONDS + 5)
+        if t.is_alive():
+            # The ramp-down is taking longer than expected (e.g. starting from above max_dac_value). Leave the LED pins set up for the controller thread, which will finish the ramp-down before the interpreter exits.
+            print("Controller is still ramping the filament down; leaving GPIO set up until it finishes.")
+        else:
+            GPIO.cleanup()
+        pi.stop()
+        close_logfile()